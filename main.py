@@ -1,19 +1,52 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, ConfigDict, field_validator
+from contextlib import asynccontextmanager
 import os
+import re
+import asyncio
+import bisect
+import hashlib
 import httpx
-from typing import List, Optional
+import orjson
+from cachetools import TTLCache
+from typing import AsyncIterator, Dict, List, Optional, Tuple, Union
 import logging
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# LanguageTool endpoint; point at a self-hosted container to skip the public API
+LANGUAGETOOL_URL = os.environ.get("LANGUAGETOOL_URL", "https://api.languagetool.org/v2/check")
+LANGUAGETOOL_TIMEOUT = float(os.environ.get("LANGUAGETOOL_TIMEOUT", 30.0))
+
+# Inputs shorter than this skip LanguageTool and only get local scoring
+MIN_LANGUAGETOOL_CHARS = int(os.environ.get("MIN_LANGUAGETOOL_CHARS", 20))
+MIN_LANGUAGETOOL_WORDS = int(os.environ.get("MIN_LANGUAGETOOL_WORDS", 4))
+
+# Longer texts are split on sentence boundaries and checked in parallel chunks
+LANGUAGETOOL_CHUNK_CHARS = int(os.environ.get("LANGUAGETOOL_CHUNK_CHARS", 10_000))
+MIN_LANGUAGETOOL_CHUNK_CHARS = 1000
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Create one shared HTTP client so connections to LanguageTool are reused"""
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(LANGUAGETOOL_TIMEOUT, connect=5.0),
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=100, keepalive_expiry=30.0)
+    )
+    yield
+    await app.state.http.aclose()
+
 app = FastAPI(
     title="AI Writing Assistant API",
     description="Free AI-powered writing assistant with grammar checking and analysis",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 # CORS middleware
@@ -21,26 +54,32 @@ app.add_middleware(
     CORSMiddleware,
     allow_origins=[
         "http://localhost:3000",
-        "https://localhost:3000",
-        "https://*.vercel.app",
-        "https://*.netlify.app",
-        "https://*.onrender.com"
+        "https://localhost:3000"
     ],
+    # CORSMiddleware doesn't expand "*" inside origins, so match hosted previews by regex
+    allow_origin_regex=r"https://[a-z0-9-]+\.(vercel\.app|netlify\.app|onrender\.com)",
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST"],
+    allow_headers=["Content-Type", "Authorization"],
 )
 
 # Pydantic models
 class TextAnalysisRequest(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
     text: str
     user_id: Optional[str] = None
+    no_cache: bool = False
+
+class Position(BaseModel):
+    start: int
+    end: int
 
 class Suggestion(BaseModel):
     id: int
     type: str
     text: str
-    position: dict
+    position: Position
     severity: str
     category: str
 
@@ -48,6 +87,24 @@ class AnalysisResponse(BaseModel):
     suggestions: List[Suggestion]
     scores: dict
 
+MAX_BATCH_ITEMS = 100
+
+class BatchRequest(BaseModel):
+    items: List[TextAnalysisRequest]
+
+    @field_validator("items")
+    @classmethod
+    def check_batch_size(cls, items: List[TextAnalysisRequest]) -> List[TextAnalysisRequest]:
+        if len(items) > MAX_BATCH_ITEMS:
+            raise ValueError(f"Batch cannot contain more than {MAX_BATCH_ITEMS} items")
+        return items
+
+class BatchError(BaseModel):
+    error: str
+
+class BatchResponse(BaseModel):
+    results: List[Union[AnalysisResponse, BatchError]]
+
 # Health check endpoint
 @app.get("/")
 async def root():
@@ -62,159 +119,367 @@ async def root():
 async def health_check():
     return {"status": "healthy", "timestamp": "2024"}
 
-# Main analysis endpoint
-@app.post("/api/analyze", response_model=AnalysisResponse)
-async def analyze_text(request: TextAnalysisRequest):
-    """Analyze text using free LanguageTool API"""
+# Tokenizer patterns, compiled once at import
+_SENTENCE_SPLIT_RE = re.compile(r'(?<=[.!?])\s+')
+# A split after one of these is an abbreviation, not a sentence end. Single-letter
+# initials are deliberately not included: "Plan B." ends a sentence far more often
+_ABBREVIATION_END_RE = re.compile(r'\b(?i:mr|mrs|ms|dr|prof|sr|jr|st|vs|e\.g|i\.e|cf|approx)\.$')
+_PARAGRAPH_SPLIT_RE = re.compile(r'\n\s*\n')
+_WORD_RE = re.compile(r'\S+')
+
+# (sentences, paragraphs, words)
+Tokens = Tuple[List[str], List[str], List[str]]
+
+def tokenize(text: str) -> Tokens:
+    """Split text into (sentences, paragraphs, words) in one place"""
+    sentences = []
+    for piece in _SENTENCE_SPLIT_RE.split(text):
+        piece = piece.strip()
+        if not piece:
+            continue
+        if sentences and _ABBREVIATION_END_RE.search(sentences[-1]):
+            sentences[-1] += " " + piece
+        else:
+            sentences.append(piece)
+    paragraphs = [p for p in (p.strip() for p in _PARAGRAPH_SPLIT_RE.split(text)) if p]
+    words = _WORD_RE.findall(text)
+    return sentences, paragraphs, words
+
+# Completed analyses keyed by (user_id, sha256(text)); LanguageTool is deterministic
+_analysis_cache = TTLCache(maxsize=10_000, ttl=3600)
+
+def analysis_cache_key(request: TextAnalysisRequest) -> tuple:
+    return (request.user_id, hashlib.sha256(request.text.encode()).hexdigest())
+
+# Raw LanguageTool responses keyed by text hash, shared across users
+_lt_cache = TTLCache(maxsize=5000, ttl=3600)
+# In-flight LanguageTool requests, so concurrent identical texts share one call
+_lt_inflight: Dict[str, asyncio.Task] = {}
+
+async def languagetool_check(client: httpx.AsyncClient, text: str, use_cache: bool = True) -> Optional[dict]:
+    """POST text to LanguageTool; returns the parsed response or None on a non-200"""
+    if not use_cache:
+        return await _languagetool_request(client, text)
+    
+    key = hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+    if key in _lt_cache:
+        return _lt_cache[key]
+    
+    task = _lt_inflight.get(key)
+    if task is None:
+        # The request runs in its own task, not in any caller's coroutine
+        task = asyncio.create_task(_languagetool_request(client, text))
+        task.add_done_callback(lambda t: _finish_languagetool_request(key, t))
+        _lt_inflight[key] = task
+    
+    # Shield so a cancelled caller (e.g. a disconnected stream) can't
+    # cancel the shared request for everyone else waiting on it
+    return await asyncio.shield(task)
+
+def _finish_languagetool_request(key: str, task: asyncio.Task) -> None:
+    _lt_inflight.pop(key, None)
+    # Checking exception() also marks it retrieved when nobody awaited the task
+    if task.cancelled() or task.exception() is not None:
+        return
+    data = task.result()
+    if data is not None:
+        _lt_cache[key] = data
+
+class LanguageToolPayloadTooLarge(Exception):
+    """LanguageTool answered 413 for a text; retry with smaller chunks"""
+
+def chunk_text(text: str, size: int) -> List[Tuple[str, int]]:
+    """Split text into (chunk, offset) pieces of at most size chars, preferring sentence ends"""
+    chunks = []
+    start = 0
+    while len(text) - start > size:
+        limit = start + size
+        cut = None
+        for match in _SENTENCE_SPLIT_RE.finditer(text, start, limit):
+            cut = match.end()
+        if cut is None:
+            # No sentence boundary in range; fall back to the last space, then a hard cut
+            space = text.rfind(" ", start, limit)
+            cut = space + 1 if space > start else limit
+        chunks.append((text[start:cut], start))
+        start = cut
+    chunks.append((text[start:], start))
+    return chunks
+
+async def languagetool_check_chunked(client: httpx.AsyncClient, text: str, use_cache: bool = True,
+                                     chunk_size: int = LANGUAGETOOL_CHUNK_CHARS) -> Optional[dict]:
+    """Check text in parallel chunks and merge matches with offsets relative to the full text"""
+    chunks = chunk_text(text, chunk_size)
     try:
-        suggestions = []
-        suggestion_id = 1
-        
-        # Basic validation
-        if not request.text or len(request.text.strip()) == 0:
-            return AnalysisResponse(
-                suggestions=[],
-                scores={
-                    "grammar": 0,
-                    "readability": 0,
-                    "tone": 0,
-                    "plagiarism": 0,
-                    "overall": 0
-                }
-            )
+        results = await asyncio.gather(*[languagetool_check(client, chunk, use_cache) for chunk, _ in chunks])
+    except LanguageToolPayloadTooLarge:
+        if chunk_size <= MIN_LANGUAGETOOL_CHUNK_CHARS:
+            raise
+        return await languagetool_check_chunked(client, text, use_cache, chunk_size // 2)
+    
+    if any(data is None for data in results):
+        return None
+    if len(results) == 1:
+        return results[0]
+    
+    # Copy matches rather than shifting offsets in place; results may be cached
+    matches = []
+    for (_, base_offset), data in zip(chunks, results):
+        for match in data.get("matches", []):
+            matches.append({**match, "offset": match.get("offset", 0) + base_offset})
+    return {"matches": matches}
+
+async def _languagetool_request(client: httpx.AsyncClient, text: str) -> Optional[dict]:
+    # LanguageTool API call
+    response = await client.post(
+        LANGUAGETOOL_URL,
+        data={
+            "text": text,
+            "language": "en-US",
+            "enabledOnly": "false"
+        }
+    )
+    
+    if response.status_code == 413:
+        raise LanguageToolPayloadTooLarge(f"LanguageTool rejected {len(text)} characters")
+    if response.status_code != 200:
+        logger.warning("LanguageTool API returned status %d", response.status_code)
+        return None
+    
+    return orjson.loads(response.content)
+
+# Suggestion severity by LanguageTool rule category id; anything else is "medium"
+_SEVERITY_BY_CATEGORY = {
+    "TYPOS": "high",
+    "GRAMMAR": "high",
+    "STYLE": "low"
+}
+
+async def check_grammar(client: httpx.AsyncClient, text: str, use_cache: bool = True) -> Tuple[List[Suggestion], bool]:
+    """Call LanguageTool and return (suggestions, whether the check succeeded)"""
+    suggestions = []
+    suggestion_id = 1
+    grammar_checked = False
+    
+    try:
+        data = await languagetool_check_chunked(client, text, use_cache)
         
-        # Free LanguageTool API call
-        try:
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.post(
-                    "https://api.languagetool.org/v2/check",
-                    data={
-                        "text": request.text,
-                        "language": "en-US",
-                        "enabledOnly": "false"
-                    }
-                )
+        if data is not None:
+            # Process LanguageTool matches
+            for match in data.get("matches", []):
+                rule = match.get("rule") or {}
+                category = rule.get("category") or {}
+                offset = match.get("offset", 0)
                 
-                if response.status_code == 200:
-                    data = response.json()
-                    
-                    # Process LanguageTool matches
-                    for match in data.get("matches", []):
-                        rule = match.get("rule", {})
-                        category = rule.get("category", {})
-                        
-                        # Determine severity based on rule category
-                        severity = "medium"
-                        if category.get("id") == "TYPOS":
-                            severity = "high"
-                        elif category.get("id") == "GRAMMAR":
-                            severity = "high"
-                        elif category.get("id") == "STYLE":
-                            severity = "low"
-                        
-                        suggestions.append({
-                            "id": suggestion_id,
-                            "type": "grammar",
-                            "text": match.get("message", "Grammar issue found"),
-                            "position": {
-                                "start": match.get("offset", 0),
-                                "end": match.get("offset", 0) + match.get("length", 0)
-                            },
-                            "severity": severity,
-                            "category": category.get("name", "Grammar")
-                        })
-                        suggestion_id += 1
-                else:
-                    logger.warning(f"LanguageTool API returned status {response.status_code}")
-                    
-        except Exception as e:
-            logger.error(f"LanguageTool API error: {e}")
-            # Add a fallback suggestion if API fails
-            suggestions.append({
-                "id": suggestion_id,
-                "type": "info",
-                "text": "Grammar check temporarily unavailable",
-                "position": {"start": 0, "end": 0},
-                "severity": "low",
-                "category": "System"
-            })
-        
-        # Basic readability analysis
-        readability_suggestions = analyze_readability(request.text, suggestion_id)
-        suggestions.extend(readability_suggestions)
-        
-        # Calculate scores
-        scores = calculate_scores(request.text, suggestions)
-        
-        logger.info(f"Analysis complete: {len(suggestions)} suggestions, overall score: {scores['overall']}")
-        
-        return AnalysisResponse(suggestions=suggestions, scores=scores)
+                suggestions.append(Suggestion(
+                    id=suggestion_id,
+                    type="grammar",
+                    text=match.get("message", "Grammar issue found"),
+                    position=Position(
+                        start=offset,
+                        end=offset + match.get("length", 0)
+                    ),
+                    severity=_SEVERITY_BY_CATEGORY.get(category.get("id"), "medium"),
+                    category=category.get("name", "Grammar")
+                ))
+                suggestion_id += 1
+            grammar_checked = True
+            
+    except Exception as e:
+        logger.error("LanguageTool API error: %s", e)
+        # Add a fallback suggestion if API fails
+        suggestions.append(Suggestion(
+            id=suggestion_id,
+            type="info",
+            text="Grammar check temporarily unavailable",
+            position=Position(start=0, end=0),
+            severity="low",
+            category="System"
+        ))
+    
+    return suggestions, grammar_checked
+
+def run_local_analysis(text: str) -> Tuple[Tokens, List[Suggestion]]:
+    """CPU-bound checks that don't depend on LanguageTool; ids start at 1"""
+    # Tokenize once and share the result between the local checks
+    tokens = tokenize(text)
+    return tokens, analyze_readability(text, tokens, 1)
+
+async def iter_analysis(client: httpx.AsyncClient, request: TextAnalysisRequest) -> AsyncIterator[Union[Suggestion, dict]]:
+    """Yield suggestions as soon as they are available, then the scores dict last"""
+    text = request.text
+    
+    # Basic validation
+    if not text or len(text.strip()) == 0:
+        yield {
+            "grammar": 0,
+            "readability": 0,
+            "tone": 0,
+            "plagiarism": 0,
+            "overall": 0
+        }
+        return
+    
+    # Tiny inputs (titles, fragments) aren't worth a LanguageTool round-trip
+    if len(text) < MIN_LANGUAGETOOL_CHARS or len(text.split(maxsplit=MIN_LANGUAGETOOL_WORDS - 1)) < MIN_LANGUAGETOOL_WORDS:
+        tokens, readability_suggestions = run_local_analysis(text)
+        for suggestion in readability_suggestions:
+            yield suggestion
+        yield calculate_scores(tokens, readability_suggestions)
+        return
+    
+    cache_key = None
+    if not request.no_cache:
+        cache_key = analysis_cache_key(request)
+        cached = _analysis_cache.get(cache_key)
+        if cached is not None:
+            for suggestion in cached.suggestions:
+                yield suggestion
+            yield cached.scores
+            return
+    
+    # Local analysis runs in a worker thread while LanguageTool is queried,
+    # so it overlaps the round-trip and doesn't block the event loop
+    local_task = asyncio.create_task(asyncio.to_thread(run_local_analysis, text))
+    try:
+        suggestions, grammar_checked = await check_grammar(client, text, use_cache=not request.no_cache)
+        for suggestion in suggestions:
+            yield suggestion
         
+        tokens, readability_suggestions = await local_task
+    finally:
+        local_task.cancel()
+    
+    # Number readability suggestions after the grammar ones
+    for suggestion in readability_suggestions:
+        suggestion.id += len(suggestions)
+        yield suggestion
+    suggestions.extend(readability_suggestions)
+    
+    # Calculate scores
+    scores = calculate_scores(tokens, suggestions)
+    
+    logger.info("Analysis complete: %d suggestions, overall score: %d", len(suggestions), scores["overall"])
+    
+    # Only cache complete results so a LanguageTool outage isn't remembered
+    if cache_key is not None and grammar_checked:
+        _analysis_cache[cache_key] = AnalysisResponse(suggestions=suggestions, scores=scores)
+    
+    yield scores
+
+async def run_analysis(client: httpx.AsyncClient, request: TextAnalysisRequest) -> AnalysisResponse:
+    """Run LanguageTool and local checks for a single text"""
+    suggestions = []
+    async for item in iter_analysis(client, request):
+        if isinstance(item, Suggestion):
+            suggestions.append(item)
+        else:
+            scores = item
+    return AnalysisResponse(suggestions=suggestions, scores=scores)
+
+# Main analysis endpoint
+@app.post("/api/analyze", response_model=AnalysisResponse)
+async def analyze_text(request: TextAnalysisRequest, http_request: Request):
+    """Analyze text using LanguageTool"""
+    try:
+        return await run_analysis(http_request.app.state.http, request)
     except Exception as e:
-        logger.error(f"Analysis error: {e}")
+        logger.error("Analysis error: %s", e)
         raise HTTPException(status_code=500, detail=f"Analysis failed: {str(e)}")
 
-def analyze_readability(text: str, start_id: int) -> List[dict]:
+# Streaming analysis endpoint
+@app.post("/api/analyze/stream")
+async def analyze_stream(request: TextAnalysisRequest, http_request: Request):
+    """Stream NDJSON: one {"suggestion": ...} line per suggestion, then {"scores": ...}"""
+    async def generate():
+        try:
+            async for item in iter_analysis(http_request.app.state.http, request):
+                if isinstance(item, Suggestion):
+                    yield orjson.dumps({"suggestion": item.model_dump()}) + b"\n"
+                else:
+                    yield orjson.dumps({"scores": item}) + b"\n"
+        except Exception as e:
+            logger.error("Analysis error: %s", e)
+            yield orjson.dumps({"error": f"Analysis failed: {str(e)}"}) + b"\n"
+    
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+# Batch analysis endpoint
+@app.post("/api/analyze/batch", response_model=BatchResponse)
+async def analyze_batch(request: BatchRequest, http_request: Request):
+    """Analyze several texts concurrently; a failed item does not abort the batch"""
+    client = http_request.app.state.http
+    results = await asyncio.gather(
+        *[run_analysis(client, item) for item in request.items],
+        return_exceptions=True
+    )
+    
+    items = []
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error("Batch item analysis error: %s", result)
+            items.append(BatchError(error=f"Analysis failed: {str(result)}"))
+        else:
+            items.append(result)
+    
+    return BatchResponse(results=items)
+
+def analyze_readability(text: str, tokens: Tokens, start_id: int) -> List[Suggestion]:
     """Analyze text readability and return suggestions"""
     suggestions = []
     current_id = start_id
+    sentences, paragraphs, _ = tokens
     
     # Check sentence length
-    sentences = [s.strip() for s in text.split('.') if s.strip()]
     long_sentences = [s for s in sentences if len(s.split()) > 25]
     
     if long_sentences:
-        suggestions.append({
-            "id": current_id,
-            "type": "readability",
-            "text": f"Consider breaking long sentences into shorter ones for better readability",
-            "position": {"start": 0, "end": len(text)},
-            "severity": "medium",
-            "category": "Readability"
-        })
+        suggestions.append(Suggestion(
+            id=current_id,
+            type="readability",
+            text="Consider breaking long sentences into shorter ones for better readability",
+            position=Position(start=0, end=len(text)),
+            severity="medium",
+            category="Readability"
+        ))
         current_id += 1
     
     # Check paragraph length
-    paragraphs = [p.strip() for p in text.split('\n\n') if p.strip()]
     long_paragraphs = [p for p in paragraphs if len(p.split()) > 150]
     
     if long_paragraphs:
-        suggestions.append({
-            "id": current_id,
-            "type": "readability",
-            "text": "Consider breaking long paragraphs into smaller ones",
-            "position": {"start": 0, "end": len(text)},
-            "severity": "low",
-            "category": "Readability"
-        })
+        suggestions.append(Suggestion(
+            id=current_id,
+            type="readability",
+            text="Consider breaking long paragraphs into smaller ones",
+            position=Position(start=0, end=len(text)),
+            severity="low",
+            category="Readability"
+        ))
         current_id += 1
     
     return suggestions
 
-def calculate_scores(text: str, suggestions: List[dict]) -> dict:
+# Average sentence length bands (inclusive upper bounds) and their readability scores
+_SENTENCE_LENGTH_BANDS = (15, 20, 25)
+_READABILITY_SCORES = (95, 85, 75, 65)
+
+def calculate_scores(tokens: Tokens, suggestions: List[Suggestion]) -> dict:
     """Calculate writing quality scores"""
     
     # Basic text metrics
-    words = text.split()
+    sentences, _, words = tokens
     word_count = len(words)
-    sentences = [s.strip() for s in text.split('.') if s.strip()]
     sentence_count = len(sentences)
     
     # Grammar score (based on grammar suggestions)
-    grammar_errors = len([s for s in suggestions if s["type"] == "grammar" and s["severity"] == "high"])
+    grammar_errors = sum(1 for s in suggestions if s.type == "grammar" and s.severity == "high")
     grammar_score = max(60, 100 - (grammar_errors * 8))
     
     # Readability score (based on sentence complexity)
     if sentence_count > 0:
         avg_sentence_length = word_count / sentence_count
-        if avg_sentence_length <= 15:
-            readability = 95
-        elif avg_sentence_length <= 20:
-            readability = 85
-        elif avg_sentence_length <= 25:
-            readability = 75
-        else:
-            readability = 65
+        readability = _READABILITY_SCORES[bisect.bisect_left(_SENTENCE_LENGTH_BANDS, avg_sentence_length)]
     else:
         readability = 50
     
@@ -250,4 +515,5 @@ async def get_documents(user_id: str):
 if __name__ == "__main__":
     import uvicorn
     port = int(os.environ.get("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
\ No newline at end of file
+    workers = int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1))
+    uvicorn.run("main:app", host="0.0.0.0", port=port, loop="uvloop", http="httptools", workers=workers)
\ No newline at end of file